@@ -0,0 +1,442 @@
+# %%
+# Planificador de lotes OData
+#
+# `ODataBatchRequest` añade las peticiones en el orden en que se llaman y las
+# corta en trozos de `max_batch_size`. En cargas mixtas eso desperdicia
+# peticiones (varios PATCH al mismo cliente, PATCH que no cambian nada) y
+# obliga a enviar cabecera y líneas de un pedido en lotes separados.
+#
+# `BatchScheduler` va delante del lote:
+# - Junta todos los PATCH a la misma URL en uno solo
+# - Descarta las escrituras que no cambian nada
+# - Respeta `dependsOn` y `atomicityGroup`, manteniendo en el mismo envoltorio
+#   las peticiones que dependen unas de otras
+# - Empaqueta el trabajo independiente para llenar envoltorios completos
+
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, Optional
+
+import requests
+from msgraphhelper.odata import ODataBatchRequest, ODataBatchResponse
+
+from batch_stream import BatchResult, stream_batch
+
+
+@dataclass
+class ScheduledRequest:
+    id: str
+    method: str
+    url: str
+    body: dict = field(default_factory=dict)
+    headers: dict = field(default_factory=dict)
+    params: dict = field(default_factory=dict)
+    depends_on: list[str] = field(default_factory=list)
+    atomicity_group: Optional[str] = None
+
+
+def _topological(items: list[str], edges: dict[str, set[str]]) -> list[str]:
+    # Orden topológico estable (Kahn), respetando el orden de llegada. Solo se
+    # tienen en cuenta las dependencias entre los propios `items`
+    remaining = {item: edges[item] & set(items) for item in items}
+    ordered: list[str] = []
+    while remaining:
+        ready = [item for item, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Dependencias circulares entre {', '.join(remaining)}")
+        for item in ready:
+            ordered.append(item)
+            del remaining[item]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return ordered
+
+
+class BatchScheduler:
+    """
+    Planificador que agrupa, deduplica y ordena peticiones antes de enviarlas
+    en uno o varios `ODataBatchRequest`
+
+    :param session: La sesión con la que enviar los lotes
+    :type session: requests.Session
+    :param batch_url: La URL del endpoint `$batch`
+    :type batch_url: str
+    :param max_batch_size: Máximo de peticiones por envoltorio, defaults to 100
+    :type max_batch_size: int, optional
+    :param continue_on_error: Continuar si falla una petición, defaults to True
+    :type continue_on_error: Optional[bool], optional
+    :param isolation_snapshot: Usar aislamiento snapshot, defaults to True
+    :type isolation_snapshot: Optional[bool], optional
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        batch_url: str,
+        max_batch_size: int = 100,
+        continue_on_error: Optional[bool] = True,
+        isolation_snapshot: Optional[bool] = True,
+    ):
+        self.session = session
+        self.batch_url = batch_url
+        self.max_batch_size = max_batch_size
+        self.continue_on_error = continue_on_error
+        self.isolation_snapshot = isolation_snapshot
+        self.requests: dict[str, ScheduledRequest] = {}
+        # id de un PATCH fusionado -> id del PATCH que lo absorbió
+        self.aliases: dict[str, str] = {}
+        # PATCH pendientes por (url, grupo de atomicidad)
+        self._patches: dict[tuple[str, Optional[str]], str] = {}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def _check_id(self, id: str):
+        if id in self.requests or id in self.aliases:
+            raise ValueError(f"Ya existe una petición con id {id}")
+
+    def request(
+        self,
+        id: str,
+        *,
+        method: str,
+        url: str,
+        body: dict = {},
+        headers: dict = {},
+        params: dict = {},
+        depends_on: Iterable[str] = (),
+        atomicity_group: Optional[str] = None,
+    ) -> str:
+        """
+        Añade una petición al planificador
+
+        :param id: El id de la petición
+        :type id: str
+        :param method: El método HTTP
+        :type method: str
+        :param url: La URL, relativa a la del `$batch`
+        :type url: str
+        :param body: El cuerpo de la petición, defaults to {}
+        :type body: dict, optional
+        :param headers: Las cabeceras, defaults to {}
+        :type headers: dict, optional
+        :param params: Los parámetros de la query, defaults to {}
+        :type params: dict, optional
+        :param depends_on: ids de peticiones o grupos de los que depende, defaults to ()
+        :type depends_on: Iterable[str], optional
+        :param atomicity_group: Grupo de atomicidad de la petición, defaults to None
+        :type atomicity_group: Optional[str], optional
+        :return: El id con el que queda la petición en el lote
+        :rtype: str
+        """
+        if method.upper() == "PATCH":
+            return self.patch(
+                id,
+                url,
+                body,
+                headers=headers,
+                params=params,
+                depends_on=depends_on,
+                atomicity_group=atomicity_group,
+            )
+        self._check_id(id)
+        self.requests[id] = ScheduledRequest(
+            id=id,
+            method=method.upper(),
+            url=url,
+            body=dict(body),
+            headers=dict(headers),
+            params=dict(params),
+            depends_on=list(depends_on),
+            atomicity_group=atomicity_group,
+        )
+        return id
+
+    def get(self, id: str, url: str, **kwargs) -> str:
+        return self.request(id, method="GET", url=url, **kwargs)
+
+    def post(self, id: str, url: str, body: dict = {}, **kwargs) -> str:
+        return self.request(id, method="POST", url=url, body=body, **kwargs)
+
+    def put(self, id: str, url: str, body: dict = {}, **kwargs) -> str:
+        return self.request(id, method="PUT", url=url, body=body, **kwargs)
+
+    def delete(self, id: str, url: str, **kwargs) -> str:
+        return self.request(id, method="DELETE", url=url, **kwargs)
+
+    def patch(
+        self,
+        id: str,
+        url: str,
+        body: dict = {},
+        *,
+        headers: dict = {},
+        params: dict = {},
+        current: Optional[dict] = None,
+        depends_on: Iterable[str] = (),
+        atomicity_group: Optional[str] = None,
+    ) -> str:
+        """
+        Añade un PATCH, fusionándolo con cualquier PATCH pendiente a la misma URL
+
+        Si se pasa `current` (la entidad tal y como la hemos leído de BC), se
+        quitan los campos que no cambian. Un PATCH que se queda sin campos no
+        se envía.
+
+        :param current: La entidad leída de BC, para descartar campos sin cambios,
+            defaults to None
+        :type current: Optional[dict], optional
+        :return: El id con el que queda la petición en el lote
+        :rtype: str
+        """
+        self._check_id(id)
+        depends_on = list(depends_on)
+        key = (url, atomicity_group)
+        previous = self.requests.get(self._patches.get(key, ""))
+
+        if previous is not None and not self._reaches(depends_on, previous.id):
+            existing = previous
+            self.aliases[id] = existing.id
+        else:
+            # Si el PATCH depende de algo que a su vez depende del PATCH anterior,
+            # no se pueden juntar: va aparte, detrás del anterior
+            existing = ScheduledRequest(
+                id=id,
+                method="PATCH",
+                url=url,
+                params=dict(params),
+                atomicity_group=atomicity_group,
+            )
+            if previous is not None:
+                existing.depends_on.append(previous.id)
+            self.requests[id] = existing
+            self._patches[key] = id
+
+        for name, value in body.items():
+            if current is not None and current.get(name) == value:
+                existing.body.pop(name, None)
+            else:
+                existing.body[name] = value
+        existing.headers.update(headers)
+        existing.params.update(params)
+        for dep in depends_on:
+            if dep not in existing.depends_on:
+                existing.depends_on.append(dep)
+        return existing.id
+
+    def _reaches(self, depends_on: Iterable[str], target: str) -> bool:
+        """
+        Indica si alguna de las dependencias lleva, directa o indirectamente,
+        a la petición `target`
+        """
+        stack = list(depends_on)
+        seen = set()
+        while stack:
+            dep = stack.pop()
+            dep = self.aliases.get(dep, dep)
+            if dep == target:
+                return True
+            if dep in seen:
+                continue
+            seen.add(dep)
+            for req in self.requests.values():
+                # Una dependencia puede ser una petición o un grupo de atomicidad
+                if req.id == dep or req.atomicity_group == dep:
+                    if req.id == target:
+                        return True
+                    stack.extend(req.depends_on)
+        return False
+
+    def _pending(self) -> dict[str, ScheduledRequest]:
+        # Los PATCH sin campos son escrituras que no cambian nada
+        return {
+            id: req
+            for id, req in self.requests.items()
+            if req.method != "PATCH" or req.body
+        }
+
+    def _resolve(self, pending: dict[str, ScheduledRequest]) -> dict[str, list[str]]:
+        """
+        Calcula las dependencias reales de cada petición pendiente: sin alias, y
+        cambiando cada petición o grupo descartado por aquello de lo que dependía
+        """
+        members: dict[str, list[ScheduledRequest]] = {}
+        for req in self.requests.values():
+            if req.atomicity_group is not None:
+                members.setdefault(req.atomicity_group, []).append(req)
+        pending_groups = {
+            req.atomicity_group
+            for req in pending.values()
+            if req.atomicity_group is not None
+        }
+
+        resolved = {}
+        for req in pending.values():
+            depends_on: list[str] = []
+            stack = list(reversed(req.depends_on))
+            seen = set()
+            while stack:
+                dep = stack.pop()
+                dep = self.aliases.get(dep, dep)
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                if dep in members:
+                    if dep in pending_groups:
+                        depends_on.append(dep)
+                        continue
+                    dropped = members[dep]
+                elif dep in self.requests:
+                    if dep in pending:
+                        depends_on.append(dep)
+                        continue
+                    dropped = [self.requests[dep]]
+                else:
+                    raise ValueError(f"{req.id} depende de {dep}, que no existe")
+                # Descartada por no cambiar nada: heredamos sus dependencias
+                for other in reversed(dropped):
+                    stack.extend(reversed(other.depends_on))
+            resolved[req.id] = depends_on
+        return resolved
+
+    def _units(
+        self, pending: dict[str, ScheduledRequest], resolved: dict[str, list[str]]
+    ) -> list[list[ScheduledRequest]]:
+        """
+        Agrupa las peticiones en unidades que tienen que ir en el mismo envoltorio,
+        ya ordenadas según sus dependencias
+        """
+
+        # Cada grupo de atomicidad es un nodo, y cada petición suelta también
+        def node_of(id: str) -> str:
+            req = pending.get(id)
+            if req is None or req.atomicity_group is None:
+                # Un grupo, o una petición suelta
+                return id
+            return req.atomicity_group
+
+        nodes: dict[str, list[str]] = {}
+        for req in pending.values():
+            nodes.setdefault(node_of(req.id), []).append(req.id)
+
+        edges: dict[str, set[str]] = {node: set() for node in nodes}
+        # Dependencias entre peticiones del mismo grupo, para ordenarlas dentro
+        inner: dict[str, set[str]] = {id: set() for id in pending}
+        for req in pending.values():
+            node = node_of(req.id)
+            for dep in resolved[req.id]:
+                dep_node = node_of(dep)
+                if dep_node != node:
+                    edges[node].add(dep_node)
+                elif dep == node:
+                    raise ValueError(f"{req.id} depende de su propio grupo {dep}")
+                else:
+                    inner[req.id].add(dep)
+
+        # Componentes conexas: lo que depende entre sí va en el mismo envoltorio
+        parent = {node: node for node in nodes}
+
+        def find(node: str) -> str:
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for node, deps in edges.items():
+            for dep in deps:
+                parent[find(node)] = find(dep)
+
+        components: dict[str, list[str]] = {}
+        for node in nodes:
+            components.setdefault(find(node), []).append(node)
+
+        units = []
+        for members in components.values():
+            unit = [
+                pending[id]
+                for node in _topological(members, edges)
+                for id in _topological(nodes[node], inner)
+            ]
+            if len(unit) > self.max_batch_size:
+                raise ValueError(
+                    f"{len(unit)} peticiones dependen entre sí y no caben "
+                    f"en un lote de {self.max_batch_size}"
+                )
+            units.append(unit)
+        return units
+
+    def _operation(
+        self, req: ScheduledRequest, depends_on: list[str], batch: ODataBatchRequest
+    ):
+        operation = batch.request(
+            req.id,
+            method=req.method,
+            url=req.url,
+            body=req.body,
+            headers=req.headers,
+            params=req.params,
+        )
+        if depends_on:
+            operation["dependsOn"] = depends_on
+        if req.atomicity_group is not None:
+            operation["atomicityGroup"] = req.atomicity_group
+
+    def batches(self) -> list[ODataBatchRequest]:
+        """
+        Devuelve los lotes a enviar, cada uno con como mucho `max_batch_size` peticiones
+
+        :return: La lista de lotes
+        :rtype: list[ODataBatchRequest]
+        """
+        pending = self._pending()
+        resolved = self._resolve(pending)
+        units = self._units(pending, resolved)
+
+        # First-fit decreasing: las unidades grandes primero, y las pequeñas
+        # rellenando los huecos
+        bins: list[list[list[ScheduledRequest]]] = []
+        sizes: list[int] = []
+        for unit in sorted(units, key=len, reverse=True):
+            for i, size in enumerate(sizes):
+                if size + len(unit) <= self.max_batch_size:
+                    bins[i].append(unit)
+                    sizes[i] += len(unit)
+                    break
+            else:
+                bins.append([unit])
+                sizes.append(len(unit))
+
+        batches = []
+        for units_in_bin in bins:
+            batch = ODataBatchRequest(
+                session=self.session,
+                batch_url=self.batch_url,
+                max_batch_size=self.max_batch_size,
+                continue_on_error=self.continue_on_error,
+                isolation_snapshot=self.isolation_snapshot,
+            )
+            for unit in units_in_bin:
+                for req in unit:
+                    self._operation(req, resolved[req.id], batch)
+            batches.append(batch)
+        return batches
+
+    def send(self) -> ODataBatchResponse:
+        """
+        Envía todos los lotes y devuelve las respuestas juntas
+
+        :return: Las respuestas de todas las peticiones, por id
+        :rtype: ODataBatchResponse
+        """
+        responses = []
+        for batch in self.batches():
+            batch.send()
+            responses.extend(batch.responses)
+        return ODataBatchResponse(responses, self)
+
+    def stream(self, **kwargs: Any) -> Iterator[BatchResult]:
+        """
+        Envía todos los lotes devolviendo las respuestas en streaming,
+        con los mismos filtros que `stream_batch`
+        """
+        for batch in self.batches():
+            yield from stream_batch(batch, **kwargs)
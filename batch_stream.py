@@ -0,0 +1,84 @@
+# %%
+# Lectura en streaming de las respuestas de un lote OData
+#
+# `ODataBatchRequest.send()` guarda todas las respuestas de todos los lotes
+# en memoria y las devuelve en un `ODataBatchResponse`. Para cargas masivas
+# (cientos de miles de peticiones) eso supone guardar el cuerpo de cada
+# entidad devuelta por BC. Aquí enviamos los lotes de uno en uno y vamos
+# devolviendo cada sub-respuesta según llega, sin acumular nada.
+
+import json
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from msgraphhelper.odata import ODataBatchRequest
+
+
+class BatchResult(NamedTuple):
+    id: str
+    status: int
+    headers: dict
+    body: Optional[dict]
+
+
+def batch_headers(batch: ODataBatchRequest) -> dict:
+    """
+    Cabeceras del `$batch`, las mismas que usa `ODataBatchRequest.send()`
+    """
+    headers = {"Accept": "application/json"}
+    if batch.isolation_snapshot:
+        headers["Isolation"] = "snapshot"
+    if batch.continue_on_error:
+        headers["Prefer"] = "odata.continue-on-error"
+    return headers
+
+
+def parse_batch_envelope(text: str) -> list[dict]:
+    """
+    Devuelve la lista de sub-respuestas de la respuesta de un `$batch`
+    """
+    # BC a veces mete BOMs de UTF-8 si la respuesta es un número
+    text = text.replace("\ufeff", "")
+    return json.loads(text)["responses"]
+
+
+def stream_batch(
+    batch: ODataBatchRequest,
+    *,
+    only_errors: bool = False,
+    fields: Optional[Iterable[str]] = None,
+) -> Iterator[BatchResult]:
+    """
+    Envía el lote y devuelve las sub-respuestas una a una como `BatchResult`
+
+    A diferencia de `batch.send()`, no guarda las respuestas en `batch.responses`
+    ni monta un `ODataBatchResponse`: cada envoltorio de hasta `max_batch_size`
+    peticiones se descarta en cuanto se han procesado sus respuestas.
+
+    :param batch: El lote a enviar
+    :type batch: ODataBatchRequest
+    :param only_errors: Devolver solo las respuestas con error (status >= 300),
+        defaults to False
+    :type only_errors: bool, optional
+    :param fields: Campos del cuerpo que se conservan (p.ej. `id` y `@odata.etag`),
+        defaults to None (se conserva el cuerpo entero)
+    :type fields: Optional[Iterable[str]], optional
+    :return: Un iterador de `BatchResult`
+    :rtype: Iterator[BatchResult]
+    """
+    headers = batch_headers(batch)
+    keep = frozenset(fields) if fields is not None else None
+
+    for keys in batch.split_requests():
+        response = batch.session.post(
+            batch.batch_url, json=batch.as_request(keys), headers=headers
+        )
+        response.raise_for_status()
+        for resp in parse_batch_envelope(response.text):
+            status = resp["status"]
+            if only_errors and status < 300:
+                continue
+            body = resp.get("body")
+            # Los errores se devuelven enteros, que si no no sabemos qué ha fallado
+            if keep is not None and isinstance(body, dict) and status < 300:
+                body = {k: v for k, v in body.items() if k in keep}
+            yield BatchResult(resp["id"], status, resp.get("headers", {}), body)
@@ -0,0 +1,252 @@
+# %%
+# Clonado de datos de una empresa a otra
+#
+# setup_demo.py monta empresas nuevas a partir de ficheros RapidStart y datos
+# de Faker. Aquí, en cambio, copiamos los clientes, proveedores y productos de
+# una empresa existente a otra (p.ej. una recién creada con
+# `automationCompanies`).
+#
+# La lectura y la escritura van a la vez: un hilo lee páginas de la empresa
+# origen y las deja en una cola limitada, y el hilo principal las va sacando,
+# transformando y enviando en lotes a la empresa destino. Si la escritura va
+# más lenta, la cola se llena y el lector espera, así que nunca tenemos más de
+# `queue_size` páginas en memoria.
+
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+import requests
+from msgraphhelper.odata import ODataBatchRequest
+
+from batch_stream import BatchResult, stream_batch
+
+# Campos que BC calcula y no se pueden enviar en un POST
+READ_ONLY_FIELDS = {
+    "@odata.etag",
+    "id",
+    "lastModifiedDateTime",
+    "balance",
+    "balanceDue",
+    "inventory",
+}
+
+# Campos que apuntan a otras tablas -> entidad del API con la que se resuelven.
+# Los ids cambian de una empresa a otra, así que los emparejamos por `code`
+REFERENCE_FIELDS = {
+    "taxAreaId": "taxAreas",
+    "currencyId": "currencies",
+    "paymentTermsId": "paymentTerms",
+    "paymentMethodId": "paymentMethods",
+    "shipmentMethodId": "shipmentMethods",
+    "itemCategoryId": "itemCategories",
+    "baseUnitOfMeasureId": "unitsOfMeasure",
+    "taxGroupId": "taxGroups",
+}
+
+EMPTY_ID = "00000000-0000-0000-0000-000000000000"
+
+# Marca de fin de la cola
+_DONE = object()
+
+
+@dataclass
+class CloneResult:
+    # entidad -> id en origen -> id en destino
+    created: dict[str, dict[str, str]] = field(default_factory=dict)
+    # entidad -> respuestas con error
+    failed: dict[str, list[BatchResult]] = field(default_factory=dict)
+
+
+def read_pages(
+    session: requests.Session, url: str, page_size: int = 1000
+) -> Iterable[list[dict]]:
+    """
+    Lee una colección de OData página a página, siguiendo `@odata.nextLink`
+    """
+    headers = {"Prefer": f"odata.maxpagesize={page_size}"}
+    while url:
+        response = session.get(url, headers=headers)
+        response.raise_for_status()
+        data = response.json()
+        if data["value"]:
+            yield data["value"]
+        url = data.get("@odata.nextLink")
+
+
+def reference_map(
+    session: requests.Session,
+    api_url: str,
+    source_company_id: str,
+    target_company_id: str,
+    entity_set: str,
+) -> dict[str, str]:
+    """
+    Empareja por `code` los ids de una tabla auxiliar (p.ej. `taxAreas`) entre dos
+    empresas
+
+    :return: id en origen -> id en destino
+    :rtype: dict[str, str]
+    """
+    target_ids = {
+        record["code"]: record["id"]
+        for page in read_pages(
+            session, f"{api_url}companies({target_company_id})/{entity_set}"
+        )
+        for record in page
+    }
+    return {
+        record["id"]: target_ids[record["code"]]
+        for page in read_pages(
+            session, f"{api_url}companies({source_company_id})/{entity_set}"
+        )
+        for record in page
+        if record["code"] in target_ids
+    }
+
+
+def clone_company(
+    session: requests.Session,
+    api_url: str,
+    source_company_id: str,
+    target_company_id: str,
+    entities: Iterable[str] = ("customers", "vendors", "items"),
+    *,
+    transform: Optional[Callable[[str, dict], Optional[dict]]] = None,
+    page_size: int = 1000,
+    queue_size: int = 4,
+    max_batch_size: int = 100,
+) -> CloneResult:
+    """
+    Copia las entidades indicadas de una empresa a otra, leyendo y escribiendo a la vez
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param api_url: La URL base del API, p.ej. `.../api/v2.0/`
+    :type api_url: str
+    :param source_company_id: El id de la empresa origen
+    :type source_company_id: str
+    :param target_company_id: El id de la empresa destino
+    :type target_company_id: str
+    :param entities: Las colecciones a copiar, en orden,
+        defaults to ("customers", "vendors", "items")
+    :type entities: Iterable[str], optional
+    :param transform: Función que recibe la entidad y el registro ya remapeado, y
+        devuelve el registro a crear o None para no copiarlo, defaults to None
+    :type transform: Optional[Callable[[str, dict], Optional[dict]]], optional
+    :param page_size: Registros por página leída, defaults to 1000
+    :type page_size: int, optional
+    :param queue_size: Páginas que pueden esperar en la cola, defaults to 4
+    :type queue_size: int, optional
+    :param max_batch_size: Peticiones por lote, defaults to 100
+    :type max_batch_size: int, optional
+    :return: Los ids creados y los errores, por entidad
+    :rtype: CloneResult
+    """
+    entities = list(entities)
+    result = CloneResult()
+    pages: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # Esperamos a que haya hueco, salvo que el escritor haya fallado
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for entity in entities:
+                url = f"{api_url}companies({source_company_id})/{entity}"
+                for page in read_pages(session, url, page_size):
+                    if not put((entity, page)):
+                        return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, name="clone-reader", daemon=True)
+    thread.start()
+
+    references: dict[str, dict[str, str]] = {}
+
+    def remap(record: dict) -> dict:
+        record = {k: v for k, v in record.items() if k not in READ_ONLY_FIELDS}
+        for name, entity_set in REFERENCE_FIELDS.items():
+            value = record.get(name)
+            if value is None:
+                continue
+            if name not in references:
+                references[name] = reference_map(
+                    session, api_url, source_company_id, target_company_id, entity_set
+                )
+            if value == EMPTY_ID or value not in references[name]:
+                # Sin equivalente en destino: dejamos que BC ponga su valor por defecto
+                del record[name]
+            else:
+                record[name] = references[name][value]
+        return record
+
+    batch_url = f"{api_url}$batch"
+    target_url = f"companies({target_company_id})"
+
+    def flush(entity: str, records: list[tuple[str, dict]]):
+        batch = ODataBatchRequest(
+            session=session,
+            batch_url=batch_url,
+            max_batch_size=max_batch_size,
+            continue_on_error=True,
+        )
+        # Usamos el id de origen como id de la petición para poder emparejarlos
+        for source_id, record in records:
+            batch.post(id=source_id, url=f"{target_url}/{entity}", body=record)
+        for response in stream_batch(batch, fields=("id",)):
+            if response.status < 300 and response.body:
+                result.created[entity][response.id] = response.body["id"]
+            else:
+                result.failed[entity].append(response)
+        logging.info(
+            f"{entity}: {len(result.created[entity])} creados, "
+            f"{len(result.failed[entity])} errores"
+        )
+
+    try:
+        pending: list[tuple[str, dict]] = []
+        current = ""
+        while True:
+            item = pages.get()
+            if isinstance(item, BaseException):
+                raise item
+            if item is _DONE:
+                if pending:
+                    flush(current, pending)
+                break
+
+            entity, page = item
+            if pending and entity != current:
+                flush(current, pending)
+                pending = []
+            current = entity
+            result.created.setdefault(entity, {})
+            result.failed.setdefault(entity, [])
+            for record in page:
+                new_record = remap(record)
+                if transform is not None:
+                    new_record = transform(entity, new_record)
+                if new_record is None:
+                    continue
+                pending.append((record["id"], new_record))
+                if len(pending) == max_batch_size:
+                    flush(entity, pending)
+                    pending = []
+    finally:
+        stop.set()
+        thread.join()
+
+    return result
@@ -0,0 +1,189 @@
+# %%
+# Recuperación automática de conflictos de etag en PATCH masivos
+#
+# Como vimos en presentacion.py, si el `If-Match` no coincide con el etag
+# actual, BC rechaza el PATCH con un 412. En un lote con `continue_on_error`
+# esos 412 se pierden entre el resto de respuestas. Aquí los recogemos,
+# volvemos a leer solo esos registros en lote, volvemos a aplicar la
+# transformación sobre los datos frescos y reenviamos con el etag nuevo,
+# hasta que no queden conflictos.
+
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+import requests
+from msgraphhelper.odata import ODataBatchRequest
+
+from batch_scheduler import BatchScheduler
+from batch_stream import stream_batch
+
+NOT_FOUND = 404
+PRECONDITION_FAILED = 412
+
+
+@dataclass
+class RecoveryResult:
+    # ids de los registros actualizados
+    updated: list[str] = field(default_factory=list)
+    # ids de los registros que no necesitaban cambios
+    unchanged: list[str] = field(default_factory=list)
+    # id -> respuesta de los errores que no son conflictos de etag
+    failed: dict[str, dict] = field(default_factory=dict)
+    # ids que siguen en conflicto tras `max_rounds` intentos
+    conflicts: list[str] = field(default_factory=list)
+    # ids que ya no existen al volver a leerlos (404)
+    missing: list[str] = field(default_factory=list)
+    rounds: int = 0
+
+
+def refetch(
+    session: requests.Session,
+    batch_url: str,
+    entity_url: str,
+    ids: Iterable[str],
+    max_batch_size: int = 100,
+) -> tuple[dict[str, dict], dict[str, dict]]:
+    """
+    Vuelve a leer en lote las entidades indicadas
+
+    Las que ya no existen (404) no aparecen en ninguno de los dos resultados.
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param batch_url: La URL del endpoint `$batch`
+    :type batch_url: str
+    :param entity_url: La URL de la colección, relativa a la del `$batch`
+        (p.ej. `companies(...)/customers`)
+    :type entity_url: str
+    :param ids: Los ids de las entidades a leer
+    :type ids: Iterable[str]
+    :return: Las entidades encontradas y las respuestas de los demás errores
+        (p.ej. 429 o 5xx), por id
+    :rtype: tuple[dict[str, dict], dict[str, dict]]
+    """
+    batch = ODataBatchRequest(
+        session=session,
+        batch_url=batch_url,
+        max_batch_size=max_batch_size,
+        isolation_snapshot=False,
+    )
+    for id in ids:
+        batch.get(id=id, url=f"{entity_url}({id})")
+
+    found = {}
+    failed = {}
+    for result in stream_batch(batch):
+        if result.status == NOT_FOUND:
+            continue
+        if result.status < 300 and result.body is not None:
+            found[result.id] = result.body
+        else:
+            failed[result.id] = result._asdict()
+    return found, failed
+
+
+def patch_with_recovery(
+    session: requests.Session,
+    batch_url: str,
+    entity_url: str,
+    records: Iterable[dict],
+    transform: Callable[[dict], Optional[dict]],
+    *,
+    max_rounds: int = 5,
+    max_batch_size: int = 100,
+) -> RecoveryResult:
+    """
+    Aplica `transform` a cada registro y envía los cambios en lote, reintentando
+    los conflictos de etag (412) con los datos recién leídos de BC
+
+    `transform` recibe la entidad y devuelve un dict con los campos a cambiar
+    (o None si no hay que cambiar nada). Por ejemplo:
+
+    ```python
+    patch_with_recovery(
+        session,
+        batch_url,
+        f"companies({company_id})/customers",
+        customers,
+        lambda c: {"taxRegistrationNumber": recalculate_tax_code(c)},
+    )
+    ```
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param batch_url: La URL del endpoint `$batch`
+    :type batch_url: str
+    :param entity_url: La URL de la colección, relativa a la del `$batch`
+    :type entity_url: str
+    :param records: Las entidades tal y como se leyeron de BC, con `@odata.etag`
+    :type records: Iterable[dict]
+    :param transform: La función que calcula los cambios de cada entidad
+    :type transform: Callable[[dict], Optional[dict]]
+    :param max_rounds: Máximo de rondas de envío, defaults to 5
+    :type max_rounds: int, optional
+    :return: El resultado de la ejecución
+    :rtype: RecoveryResult
+    """
+    result = RecoveryResult()
+    pending = {record["id"]: record for record in records}
+
+    while pending and result.rounds < max_rounds:
+        result.rounds += 1
+        scheduler = BatchScheduler(
+            session=session,
+            batch_url=batch_url,
+            max_batch_size=max_batch_size,
+            continue_on_error=True,
+            isolation_snapshot=False,
+        )
+        for id, record in pending.items():
+            scheduler.patch(
+                id,
+                f"{entity_url}({id})",
+                transform(record) or {},
+                headers={
+                    "Content-Type": "application/json",
+                    "If-Match": record["@odata.etag"],
+                },
+                current=record,
+            )
+
+        sent = set()
+        conflicts = []
+        for batch in scheduler.batches():
+            sent.update(batch)
+            for response in stream_batch(batch, fields=("id", "@odata.etag")):
+                if response.status < 300:
+                    result.updated.append(response.id)
+                elif response.status == PRECONDITION_FAILED:
+                    conflicts.append(response.id)
+                else:
+                    result.failed[response.id] = response._asdict()
+        result.unchanged.extend(id for id in pending if id not in sent)
+
+        logging.info(
+            f"Ronda {result.rounds}: {len(sent)} enviados, "
+            f"{len(conflicts)} conflictos de etag"
+        )
+        if not conflicts:
+            pending = {}
+            break
+        if result.rounds == max_rounds:
+            # No quedan rondas: no vale la pena volver a leerlos
+            result.conflicts.extend(conflicts)
+            pending = {}
+            break
+
+        fresh, failed = refetch(
+            session, batch_url, entity_url, conflicts, max_batch_size
+        )
+        # Si falla la lectura (p.ej. por throttling) no sabemos si existen
+        result.failed.update(failed)
+        result.missing.extend(
+            id for id in conflicts if id not in fresh and id not in failed
+        )
+        pending = fresh
+
+    result.conflicts.extend(pending)
+    return result
@@ -0,0 +1,292 @@
+# %%
+# Caché de GET para la sesión de BC
+#
+# Varios hilos de un mismo proceso suelen pedir lo mismo a la vez (la empresa,
+# los `taxAreas`, el mismo cliente al resolver conflictos...), y cada petición
+# gasta cuota del API. Este adaptador de `requests` se monta en la sesión y:
+# - Junta los GET idénticos simultáneos en una sola petición (single-flight)
+# - Guarda las respuestas en una caché LRU limitada en número y en tamaño
+# - Cuando una entrada caduca, la revalida con `If-None-Match` y el etag de la
+#   entidad, así que si no ha cambiado BC contesta un 304 sin cuerpo
+#
+# Las escrituras (PATCH, POST, PUT, DELETE) que pasan por la sesión invalidan
+# la entidad y su colección. En un `$batch` se mira cada petición de dentro, y
+# solo si no se puede leer el cuerpo se vacía la caché entera.
+
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, requote_uri
+
+NOT_MODIFIED = 304
+
+# Última clave entre paréntesis de una URL de OData: `.../customers(1234)`
+_ENTITY_KEY = re.compile(r"\([^()]*\)$")
+
+
+@dataclass
+class CacheEntry:
+    status_code: int
+    headers: CaseInsensitiveDict
+    content: bytes
+    reason: Optional[str]
+    etag: Optional[str]
+    fetched: float
+
+    @classmethod
+    def from_response(cls, response: requests.Response) -> "CacheEntry":
+        content = response.content
+        etag = response.headers.get("ETag")
+        if etag is None and response.status_code == 200:
+            # BC pone el etag en el cuerpo de cada entidad
+            try:
+                etag = json.loads(content).get("@odata.etag")
+            except (ValueError, AttributeError):
+                etag = None
+        return cls(
+            status_code=response.status_code,
+            headers=CaseInsensitiveDict(response.headers),
+            content=content,
+            reason=response.reason,
+            etag=etag,
+            fetched=time.monotonic(),
+        )
+
+    def response(self, request: requests.PreparedRequest) -> requests.Response:
+        # Cada llamada recibe su propio Response, para que nadie modifique el de otro
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.content
+        response._content_consumed = True  # type: ignore
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = self.reason  # type: ignore
+        response.url = request.url  # type: ignore
+        response.request = request
+        return response
+
+
+@dataclass
+class _Flight:
+    done: threading.Event = field(default_factory=threading.Event)
+    entry: Optional[CacheEntry] = None
+    error: Optional[BaseException] = None
+
+
+def _base_url(url: str) -> str:
+    return url.split("?", 1)[0]
+
+
+def _batch_writes(request: requests.PreparedRequest) -> Optional[list[str]]:
+    # Las URLs (sin parámetros) en las que escriben las peticiones de un `$batch`,
+    # o None si no se entiende el cuerpo
+    if not isinstance(request.body, (str, bytes)):
+        return None
+    batch_url = request.url or ""
+    try:
+        operations = json.loads(request.body)["requests"]
+        urls = [
+            urljoin(batch_url, operation["url"])
+            for operation in operations
+            if operation["method"].upper() != "GET"
+        ]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    return [_base_url(requote_uri(url)) for url in urls]
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    Adaptador de `requests` con caché de GET, single-flight y revalidación por etag
+
+    :param ttl: Segundos que una respuesta se da por buena sin revalidarla,
+        defaults to 30
+    :type ttl: float, optional
+    :param max_entries: Máximo de respuestas guardadas, defaults to 1024
+    :type max_entries: int, optional
+    :param max_bytes: Máximo de bytes guardados entre todas las respuestas,
+        defaults to 64 MB
+    :type max_bytes: int, optional
+    :param kwargs: Se pasan a `HTTPAdapter` (p.ej. `pool_maxsize`)
+    """
+
+    def __init__(
+        self,
+        ttl: float = 30,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._flights: dict[tuple, _Flight] = {}
+        self._lock = threading.Lock()
+        # Sube con cada invalidación: si cambia mientras un GET está en vuelo,
+        # su respuesta puede ser de antes de la escritura y no se guarda
+        self.generation = 0
+
+    def _key(self, request: requests.PreparedRequest) -> tuple:
+        # La autenticación es la misma para toda la sesión, no forma parte de la clave
+        headers = request.headers
+        return (request.url, headers.get("Accept"), headers.get("Prefer"))
+
+    def _store(self, key: tuple, entry: CacheEntry):
+        # Llamar con el lock cogido
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old.content)
+        if entry.status_code != 200 or len(entry.content) > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.size += len(entry.content)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.content)
+
+    def invalidate(self, url: Optional[str] = None):
+        """
+        Quita de la caché las respuestas de una URL, o todas si no se indica
+
+        :param url: La URL sin parámetros de la entidad o colección, defaults to None
+        :type url: Optional[str], optional
+        """
+        with self._lock:
+            self.generation += 1
+            if url is None:
+                self.entries.clear()
+                self.size = 0
+                return
+            for key in [key for key in self.entries if _base_url(key[0]) == url]:
+                self.size -= len(self.entries.pop(key).content)
+
+    def _invalidate_write(self, request: requests.PreparedRequest):
+        url = _base_url(request.url or "")
+        urls = [url]
+        if url.endswith("$batch"):
+            urls = _batch_writes(request)
+            if urls is None:
+                self.invalidate()
+                return
+        for url in urls:
+            # La entidad y la colección a la que pertenece
+            self.invalidate(url)
+            self.invalidate(_ENTITY_KEY.sub("", url))
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout=None,
+        verify: bool | str = True,
+        cert=None,
+        proxies=None,
+    ) -> requests.Response:
+        if request.method != "GET":
+            # Invalidamos antes y después: un GET que salga mientras se hace la
+            # escritura también podría traer los datos de antes
+            self._invalidate_write(request)
+            try:
+                return super().send(request, stream, timeout, verify, cert, proxies)
+            finally:
+                self._invalidate_write(request)
+
+        headers = request.headers
+        if stream or "If-None-Match" in headers or "If-Match" in headers:
+            # Descargas por trozos y peticiones condicionales del propio llamante
+            return super().send(request, stream, timeout, verify, cert, proxies)
+
+        key = self._key(request)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry.fetched < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry.response(request)
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            generation = self.generation
+        assert flight is not None
+
+        if not leader:
+            # Ya hay alguien pidiendo lo mismo: esperamos a su respuesta
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            assert flight.entry is not None
+            with self._lock:
+                self.hits += 1
+            return flight.entry.response(request)
+
+        try:
+            if entry is not None and entry.etag is not None:
+                revalidation = request.copy()
+                revalidation.headers["If-None-Match"] = entry.etag
+                response = super().send(
+                    revalidation, False, timeout, verify, cert, proxies
+                )
+            else:
+                response = super().send(request, False, timeout, verify, cert, proxies)
+
+            with self._lock:
+                # Si ha habido una escritura mientras tanto no guardamos nada
+                current = self.generation == generation
+                if entry is not None and response.status_code == NOT_MODIFIED:
+                    response.close()
+                    if current:
+                        entry.fetched = time.monotonic()
+                        self._store(key, entry)
+                    self.revalidations += 1
+                else:
+                    entry = CacheEntry.from_response(response)
+                    if current:
+                        self._store(key, entry)
+                    self.misses += 1
+            flight.entry = entry
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return entry.response(request)
+
+
+def enable_cache(session: requests.Session, **kwargs) -> CachingAdapter:
+    """
+    Monta un `CachingAdapter` en la sesión para todas las URLs https
+
+    ```python
+    session = msgraphhelper.get_graph_session(credential, scope)
+    cache = enable_cache(session, ttl=60)
+    ```
+
+    :param session: La sesión de BC
+    :type session: requests.Session
+    :param kwargs: Se pasan a `CachingAdapter`
+    :return: El adaptador, para consultar estadísticas o invalidar a mano
+    :rtype: CachingAdapter
+    """
+    adapter = CachingAdapter(**kwargs)
+    session.mount("https://", adapter)
+    return adapter
@@ -0,0 +1,237 @@
+# %%
+# Descarga en paralelo de imágenes de productos y adjuntos
+#
+# `items?$expand=*` trae los metadatos de la imagen de cada producto, pero el
+# contenido hay que pedirlo aparte, producto a producto. Aquí lo pedimos en
+# paralelo con un pool de hilos sobre la misma sesión, y lo vamos escribiendo
+# a disco por trozos, sin tener el fichero entero en memoria.
+#
+# Los ficheros se guardan por su hash SHA-256, así que el mismo contenido solo
+# se guarda una vez. Un manifiesto (`manifest.json`) guarda el etag y el hash de
+# cada imagen, y en las siguientes ejecuciones nos saltamos las que no han
+# cambiado sin llegar a pedirlas.
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+import requests
+from msgraphhelper.odata import ODataPaginator
+from requests.adapters import DEFAULT_POOLBLOCK, DEFAULT_POOLSIZE, HTTPAdapter
+
+CHUNK_SIZE = 64 * 1024
+MANIFEST_NAME = "manifest.json"
+
+
+class MediaItem(NamedTuple):
+    # Clave con la que se guarda en el manifiesto, p.ej. `items/1000`
+    key: str
+    url: str
+    etag: Optional[str] = None
+    content_type: Optional[str] = None
+
+
+@dataclass
+class DownloadResult:
+    # clave -> hash del contenido
+    downloaded: dict[str, str] = field(default_factory=dict)
+    # claves que no han cambiado desde la última vez
+    skipped: list[str] = field(default_factory=list)
+    # claves cuyo contenido ya teníamos con otro nombre
+    deduplicated: list[str] = field(default_factory=list)
+    # clave -> error
+    failed: dict[str, str] = field(default_factory=dict)
+
+
+def item_pictures(session: requests.Session, company_url: str) -> Iterator[MediaItem]:
+    """
+    Lista las imágenes de los productos que tienen imagen
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param company_url: La URL de la empresa, p.ej. `.../api/v2.0/companies(...)/`
+    :type company_url: str
+    :return: Un iterador de `MediaItem`
+    :rtype: Iterator[MediaItem]
+    """
+    response = session.get(f"{company_url}items", params={"$expand": "picture"})
+    response.raise_for_status()
+    for item in ODataPaginator(response, session):
+        picture = item.get("picture") or {}
+        if not picture.get("contentType"):
+            continue
+        yield MediaItem(
+            key=f"items/{item['number']}",
+            url=f"{company_url}items({item['id']})/picture/pictureContent",
+            etag=picture.get("@odata.etag"),
+            content_type=picture["contentType"],
+        )
+
+
+def document_attachments(
+    session: requests.Session, company_url: str
+) -> Iterator[MediaItem]:
+    """
+    Lista los adjuntos de documentos (`documentAttachments`)
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param company_url: La URL de la empresa, p.ej. `.../api/v2.0/companies(...)/`
+    :type company_url: str
+    :return: Un iterador de `MediaItem`
+    :rtype: Iterator[MediaItem]
+    """
+    response = session.get(f"{company_url}documentAttachments")
+    response.raise_for_status()
+    for attachment in ODataPaginator(response, session):
+        yield MediaItem(
+            key=f"documentAttachments/{attachment['parentType']}/"
+            f"{attachment['parentId']}/{attachment['fileName']}",
+            url=f"{company_url}documentAttachments({attachment['id']})"
+            "/attachmentContent",
+            etag=attachment.get("@odata.etag"),
+            content_type=mimetypes.guess_type(attachment["fileName"])[0],
+        )
+
+
+def ensure_pool_size(session: requests.Session, size: int):
+    """
+    Se asegura de que la sesión puede tener `size` conexiones abiertas a la vez
+
+    Por defecto `requests` solo guarda 10 conexiones por host, y con más hilos
+    se abrirían y cerrarían conexiones constantemente.
+    """
+    adapter = session.get_adapter("https://")
+    if not isinstance(adapter, HTTPAdapter):
+        session.mount("https://", HTTPAdapter(pool_maxsize=size))
+        return
+
+    pool_kw = adapter.poolmanager.connection_pool_kw
+    if pool_kw.get("maxsize", 1) < size:
+        # Reutilizamos el adaptador que haya (p.ej. el de `http_cache`), cerrando
+        # antes las conexiones del pool viejo
+        adapter.poolmanager.clear()
+        adapter.init_poolmanager(
+            DEFAULT_POOLSIZE, size, block=pool_kw.get("block", DEFAULT_POOLBLOCK)
+        )
+
+
+def _object_path(target_dir: Path, digest: str, content_type: Optional[str]) -> Path:
+    extension = mimetypes.guess_extension(content_type or "") or ""
+    return target_dir / digest[:2] / f"{digest}{extension}"
+
+
+def _download(
+    session: requests.Session, media: MediaItem, target_dir: Path
+) -> tuple[str, Optional[str], bool]:
+    # Escribimos a un temporal calculando el hash por el camino, y luego lo
+    # movemos a su sitio definitivo (o lo borramos si ya lo teníamos)
+    sha256 = hashlib.sha256()
+    with session.get(media.url, stream=True) as response:
+        response.raise_for_status()
+        content_type = media.content_type or response.headers.get("Content-Type")
+        with tempfile.NamedTemporaryFile(dir=target_dir, delete=False) as file:
+            try:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    file.write(chunk)
+            except BaseException:
+                file.close()
+                os.unlink(file.name)
+                raise
+
+    digest = sha256.hexdigest()
+    path = _object_path(target_dir, digest, content_type)
+    if path.exists():
+        os.unlink(file.name)
+        return digest, content_type, True
+    path.parent.mkdir(exist_ok=True)
+    os.replace(file.name, path)
+    return digest, content_type, False
+
+
+def download_media(
+    session: requests.Session,
+    media: Iterable[MediaItem],
+    target_dir: str | Path,
+    *,
+    workers: int = 16,
+) -> DownloadResult:
+    """
+    Descarga en paralelo el contenido de `media` a `target_dir`, guardando cada
+    contenido distinto una sola vez y saltándose lo que no ha cambiado
+
+    ```python
+    download_media(session, item_pictures(session, company_baseurl), "imagenes")
+    ```
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param media: Lo que hay que descargar
+    :type media: Iterable[MediaItem]
+    :param target_dir: La carpeta donde guardar los ficheros y el manifiesto
+    :type target_dir: str | Path
+    :param workers: Descargas simultáneas, defaults to 16
+    :type workers: int, optional
+    :return: El resultado de la descarga
+    :rtype: DownloadResult
+    """
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = target_dir / MANIFEST_NAME
+    manifest: dict[str, dict] = {}
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+
+    ensure_pool_size(session, workers)
+    result = DownloadResult()
+
+    def unchanged(item: MediaItem) -> bool:
+        entry = manifest.get(item.key)
+        if entry is None or item.etag is None or entry["etag"] != item.etag:
+            return False
+        return _object_path(target_dir, entry["sha256"], entry["contentType"]).exists()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for item in media:
+                if unchanged(item):
+                    result.skipped.append(item.key)
+                    continue
+                future = executor.submit(_download, session, item, target_dir)
+                futures[future] = item
+
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    digest, content_type, duplicate = future.result()
+                except Exception as e:
+                    logging.warning(f"Error descargando {item.key}: {e}")
+                    result.failed[item.key] = str(e)
+                    continue
+                manifest[item.key] = {
+                    "etag": item.etag,
+                    "sha256": digest,
+                    "contentType": content_type,
+                }
+                result.downloaded[item.key] = digest
+                if duplicate:
+                    result.deduplicated.append(item.key)
+    finally:
+        # Guardamos el manifiesto aunque falle algo, para no repetir lo ya bajado
+        manifest_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    logging.info(
+        f"{len(result.downloaded)} descargados "
+        f"({len(result.deduplicated)} repetidos), "
+        f"{len(result.skipped)} sin cambios, {len(result.failed)} errores"
+    )
+    return result
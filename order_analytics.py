@@ -0,0 +1,396 @@
+# %%
+# Análisis de pedidos de venta y compra en memoria
+#
+# En lugar de pedir `salesOrders?$expand=salesOrderLines` en cada informe y
+# agregar con bucles sobre dicts, cargamos las cabeceras y las líneas en
+# columnas de NumPy, con los códigos de cliente/proveedor, producto y divisa
+# codificados como enteros (codificación por diccionario).
+#
+# Las sumas por cliente, producto y divisa se mantienen al día de forma
+# incremental: al llegar un pedido modificado restamos lo que aportaba antes
+# y sumamos lo nuevo, sin recalcular todo.
+
+from datetime import date
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import requests
+from msgraphhelper.odata import ODataPaginator
+
+# Nombres de las colecciones y campos según el tipo de pedido
+ORDER_KINDS = {
+    "sales": {
+        "entity": "salesOrders",
+        "lines": "salesOrderLines",
+        "party": "customerNumber",
+    },
+    "purchase": {
+        "entity": "purchaseOrders",
+        "lines": "purchaseOrderLines",
+        "party": "vendorNumber",
+    },
+}
+
+# Dimensiones por las que se puede agrupar, y medidas que se pueden sumar
+DIMENSIONS = ("party", "item", "currency")
+MEASURES = ("quantity", "amount")
+
+# Por debajo de esto una suma se considera 0
+TOLERANCE = 1e-6
+
+
+def _nonzero(sums: np.ndarray) -> np.ndarray:
+    # Al restar pedidos quedan restos de coma flotante donde debería haber un 0
+    return np.flatnonzero(np.abs(sums) > TOLERANCE)
+
+
+class Dictionary:
+    """
+    Codificación por diccionario: cada valor distinto recibe un entero
+    """
+
+    def __init__(self):
+        self.codes: dict[str, int] = {}
+        self.values: list[str] = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class Column:
+    """
+    Columna de NumPy que crece duplicando su capacidad, para poder añadir filas
+    sin copiar el array entero cada vez
+    """
+
+    def __init__(self, dtype, capacity: int = 1024):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def values(self) -> np.ndarray:
+        return self.data[: self.size]
+
+    def extend(self, values) -> slice:
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            data = np.zeros(max(needed, 2 * len(self.data)), dtype=self.data.dtype)
+            data[: self.size] = self.values
+            self.data = data
+        rows = slice(self.size, needed)
+        self.data[rows] = values
+        self.size = needed
+        return rows
+
+    def keep(self, mask: np.ndarray):
+        kept = self.values[mask]
+        self.data[: len(kept)] = kept
+        self.size = len(kept)
+
+
+def load_orders(
+    session: requests.Session,
+    company_url: str,
+    kind: str = "sales",
+    modified_since: Optional[str] = None,
+) -> Iterator[dict]:
+    """
+    Descarga los pedidos con sus líneas, opcionalmente solo los modificados desde
+    una fecha
+
+    :param session: La sesión con la que hacer las peticiones
+    :type session: requests.Session
+    :param company_url: La URL de la empresa, p.ej. `.../api/v2.0/companies(...)/`
+    :type company_url: str
+    :param kind: "sales" o "purchase", defaults to "sales"
+    :type kind: str, optional
+    :param modified_since: Valor de `lastModifiedDateTime` a partir del que leer,
+        defaults to None
+    :type modified_since: Optional[str], optional
+    :return: Un iterador de pedidos
+    :rtype: Iterator[dict]
+    """
+    names = ORDER_KINDS[kind]
+    params = {"$expand": names["lines"]}
+    if modified_since:
+        params["$filter"] = f"lastModifiedDateTime gt {modified_since}"
+    response = session.get(f"{company_url}{names['entity']}", params=params)
+    response.raise_for_status()
+    return iter(ODataPaginator(response, session))
+
+
+class OrderAnalytics:
+    """
+    Pedidos en columnas de NumPy, con sumas por dimensión mantenidas al día
+
+    ```python
+    analytics = OrderAnalytics("sales")
+    analytics.refresh(session, company_baseurl)
+    analytics.top(10, "item")  # los 10 productos más vendidos por importe
+    ...
+    analytics.refresh(session, company_baseurl)  # solo trae los modificados
+    ```
+
+    :param kind: "sales" o "purchase", defaults to "sales"
+    :type kind: str, optional
+    """
+
+    def __init__(self, kind: str = "sales"):
+        self.kind = kind
+        self.names = ORDER_KINDS[kind]
+        self.dictionaries = {dimension: Dictionary() for dimension in DIMENSIONS}
+        self.last_modified: Optional[str] = None
+
+        # Cabeceras
+        self.order_rows: dict[str, int] = {}
+        self.order_party = Column(np.int32)
+        self.order_currency = Column(np.int32)
+        self.order_date = Column("datetime64[D]")
+        self.order_total = Column(np.float64)
+        self.order_alive = Column(np.bool_)
+        # Las líneas de un pedido van seguidas: guardamos dónde empiezan y acaban
+        self.order_line_start = Column(np.int64)
+        self.order_line_stop = Column(np.int64)
+
+        # Líneas, con las dimensiones de la cabecera repetidas para agrupar rápido
+        self.line_order = Column(np.int64)
+        self.line_party = Column(np.int32)
+        self.line_item = Column(np.int32)
+        self.line_currency = Column(np.int32)
+        self.line_quantity = Column(np.float64)
+        self.line_amount = Column(np.float64)
+        self.line_alive = Column(np.bool_)
+
+        # (dimensión, medida) -> suma por código
+        self.sums = {
+            (dimension, measure): np.zeros(0)
+            for dimension in DIMENSIONS
+            for measure in MEASURES
+        }
+
+    def __len__(self):
+        return len(self.order_rows)
+
+    def _line_columns(self, dimension: str) -> Column:
+        return getattr(self, f"line_{dimension}")
+
+    def _accumulate(self, lines: slice | np.ndarray, sign: float):
+        for (dimension, measure), sums in self.sums.items():
+            codes = self._line_columns(dimension).values[lines]
+            weights = self._line_columns(measure).values[lines] * sign
+            size = len(self.dictionaries[dimension])
+            if len(sums) < size:
+                sums = np.concatenate([sums, np.zeros(size - len(sums))])
+            sums += np.bincount(codes, weights=weights, minlength=size)
+            self.sums[dimension, measure] = sums
+
+    def remove(self, order_ids: Iterable[str]):
+        """
+        Quita pedidos (p.ej. borrados o registrados en BC) de los agregados
+        """
+        rows = [self.order_rows.pop(id) for id in order_ids if id in self.order_rows]
+        if not rows:
+            return
+        starts = self.order_line_start.values[rows]
+        stops = self.order_line_stop.values[rows]
+        lines = np.concatenate(
+            [np.arange(start, stop) for start, stop in zip(starts, stops)]
+        ).astype(np.int64)
+        self._accumulate(lines, -1.0)
+        self.order_alive.values[rows] = False
+        self.line_alive.values[lines] = False
+
+        # Si hay más filas muertas que vivas, compactamos
+        if len(self.order_rows) * 2 < len(self.order_alive):
+            self.compact()
+
+    def upsert(self, orders: Iterable[dict]):
+        """
+        Añade pedidos nuevos o sustituye los que ya estaban, actualizando los
+        agregados con la diferencia
+
+        :param orders: Pedidos de BC, con las líneas expandidas
+        :type orders: Iterable[dict]
+        """
+        # Si un pedido viene repetido nos quedamos con la última versión
+        orders = list({order["id"]: order for order in orders}.values())
+        if not orders:
+            return
+        self.remove(order["id"] for order in orders)
+
+        party, currency = self.dictionaries["party"], self.dictionaries["currency"]
+        item = self.dictionaries["item"]
+        first_line = len(self.line_order)
+        first_order = len(self.order_alive)
+
+        order_party = []
+        order_currency = []
+        line_order = []
+        line_item = []
+        line_quantity = []
+        line_amount = []
+        line_start = []
+        line_stop = []
+        for row, order in enumerate(orders, start=first_order):
+            self.order_rows[order["id"]] = row
+            order_party.append(party.encode(order[self.names["party"]]))
+            order_currency.append(currency.encode(order.get("currencyCode", "")))
+            lines = order.get(self.names["lines"], [])
+            line_start.append(first_line + len(line_order))
+            for line in lines:
+                line_order.append(row)
+                line_item.append(item.encode(line.get("lineObjectNumber", "")))
+                line_quantity.append(line.get("quantity", 0.0))
+                line_amount.append(line.get("amountExcludingTax", 0.0))
+            line_stop.append(first_line + len(line_order))
+
+            modified = order.get("lastModifiedDateTime")
+            if modified and modified > (self.last_modified or ""):
+                self.last_modified = modified
+
+        self.order_party.extend(order_party)
+        self.order_currency.extend(order_currency)
+        self.order_date.extend([order["orderDate"] for order in orders])
+        self.order_total.extend(
+            [order.get("totalAmountExcludingTax", 0.0) for order in orders]
+        )
+        self.order_alive.extend(np.ones(len(orders), dtype=np.bool_))
+        self.order_line_start.extend(line_start)
+        self.order_line_stop.extend(line_stop)
+
+        order_party = np.asarray(order_party, dtype=np.int32)
+        order_currency = np.asarray(order_currency, dtype=np.int32)
+        header = np.asarray(line_order, dtype=np.int64) - first_order
+        self.line_order.extend(line_order)
+        self.line_party.extend(order_party[header])
+        self.line_currency.extend(order_currency[header])
+        self.line_item.extend(line_item)
+        self.line_quantity.extend(line_quantity)
+        self.line_amount.extend(line_amount)
+        lines = self.line_alive.extend(np.ones(len(line_order), dtype=np.bool_))
+
+        self._accumulate(lines, 1.0)
+
+    def refresh(self, session: requests.Session, company_url: str):
+        """
+        Descarga los pedidos modificados desde la última carga y los aplica
+
+        Los pedidos borrados en BC no aparecen aquí: hay que quitarlos con `remove`.
+        """
+        self.upsert(load_orders(session, company_url, self.kind, self.last_modified))
+
+    def compact(self):
+        """
+        Elimina las filas de pedidos sustituidos o quitados
+        """
+        orders_alive = self.order_alive.values.copy()
+        lines_alive = self.line_alive.values.copy()
+
+        # Nueva posición de cada pedido y de cada línea
+        new_order_row = np.cumsum(orders_alive) - 1
+        lines_before = np.concatenate([[0], np.cumsum(lines_alive)])
+
+        for column in (
+            self.order_party,
+            self.order_currency,
+            self.order_date,
+            self.order_total,
+            self.order_line_start,
+            self.order_line_stop,
+            self.order_alive,
+        ):
+            column.keep(orders_alive)
+        self.order_line_start.values[:] = lines_before[self.order_line_start.values]
+        self.order_line_stop.values[:] = lines_before[self.order_line_stop.values]
+
+        for column in (
+            self.line_order,
+            self.line_party,
+            self.line_item,
+            self.line_currency,
+            self.line_quantity,
+            self.line_amount,
+            self.line_alive,
+        ):
+            column.keep(lines_alive)
+        self.line_order.values[:] = new_order_row[self.line_order.values]
+
+        self.order_rows = {
+            id: int(new_order_row[row]) for id, row in self.order_rows.items()
+        }
+
+    def group_sum(
+        self,
+        dimension: str,
+        measure: str = "amount",
+        since: Optional[date | str] = None,
+        until: Optional[date | str] = None,
+    ) -> np.ndarray:
+        """
+        Suma una medida de las líneas agrupada por dimensión
+
+        Sin filtro de fechas se devuelve la suma que ya tenemos mantenida; con
+        filtro se calcula sobre las columnas.
+
+        :param dimension: "party", "item" o "currency"
+        :type dimension: str
+        :param measure: "amount" o "quantity", defaults to "amount"
+        :type measure: str, optional
+        :param since: Fecha de pedido mínima (incluida), defaults to None
+        :type since: Optional[date | str], optional
+        :param until: Fecha de pedido máxima (incluida), defaults to None
+        :type until: Optional[date | str], optional
+        :return: La suma por código de la dimensión
+        :rtype: np.ndarray
+        """
+        size = len(self.dictionaries[dimension])
+        if since is None and until is None:
+            sums = self.sums[dimension, measure]
+            return np.concatenate([sums, np.zeros(size - len(sums))])
+
+        dates = self.order_date.values[self.line_order.values]
+        mask = self.line_alive.values.copy()
+        if since is not None:
+            mask &= dates >= np.datetime64(since, "D")
+        if until is not None:
+            mask &= dates <= np.datetime64(until, "D")
+        return np.bincount(
+            self._line_columns(dimension).values[mask],
+            weights=self._line_columns(measure).values[mask],
+            minlength=size,
+        )
+
+    def sum_by(self, dimension: str, measure: str = "amount", **filters) -> dict:
+        """
+        Como `group_sum`, pero devolviendo un dict código -> suma
+        """
+        sums = self.group_sum(dimension, measure, **filters)
+        values = self.dictionaries[dimension].values
+        return {values[code]: float(sums[code]) for code in _nonzero(sums)}
+
+    def top(
+        self, n: int, dimension: str, measure: str = "amount", **filters
+    ) -> list[tuple[str, float]]:
+        """
+        Los `n` valores de la dimensión con la suma más alta, de mayor a menor
+        """
+        if n <= 0:
+            return []
+        sums = self.group_sum(dimension, measure, **filters)
+        codes = _nonzero(sums)
+        if n < len(codes):
+            codes = codes[np.argpartition(sums[codes], -n)[-n:]]
+        codes = codes[np.argsort(sums[codes])[::-1]]
+        values = self.dictionaries[dimension].values
+        return [(values[code], float(sums[code])) for code in codes]
@@ -75,6 +75,8 @@ def recalculate_tax_code(customer: dict):
 # Creamos un lote
 from msgraphhelper.odata import ODataBatchRequest
 
+from tax_validation import validate_tax_number
+
 batch_url = f"{api_baseurl}$batch"
 
 batch = ODataBatchRequest(
@@ -91,6 +93,13 @@ for customer in customers:
             f"NIF: {customer['taxRegistrationNumber']}"
         )
         continue
+    if not validate_tax_number(new_nif, customer["country"]):
+        print(
+            f"Cliente {customer['displayName']} tiene un NIF inválido. "
+            f"Pais: {customer['country']} "
+            f"NIF: {new_nif}"
+        )
+        continue
     batch.patch(
         id=customer["number"],
         url=f"companies({company_id})/customers({customer['id']})",  # Relativo a la URL del $batch
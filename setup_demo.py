@@ -356,8 +356,13 @@ for x in range(600):
     )
 
 # %%
+# Enviamos el lote en streaming, quedándonos solo con los errores
+from batch_stream import stream_batch
 
-response = batch_request.send()
+for result in stream_batch(batch_request, only_errors=True):
+    logging.error(
+        f"Error creando cliente {result.id}: {result.status} {result.body}"
+    )
 
 # %%
 import webbrowser
@@ -0,0 +1,323 @@
+# %%
+# Validación masiva de NIF/CIF/NIE y números de IVA europeos
+#
+# `recalculate_tax_code` solo añade el prefijo del país, pero no comprueba que
+# el número resultante sea válido. Aquí comprobamos los dígitos de control de
+# los NIF, NIE y CIF españoles y el formato del número de IVA de cada país de
+# `PAISES_EUROPEOS`, para poder sacar los registros inválidos antes de enviar
+# nada a BC.
+#
+# Las reglas se compilan una vez por país. Al validar una columna entera no
+# vamos número a número: cada país pasa su regex una sola vez sobre todos sus
+# números (uno por línea), y los dígitos de control españoles se calculan con
+# NumPy sobre todos a la vez.
+
+import re
+from typing import Callable, Iterable, Sequence
+
+import numpy as np
+
+# fmt: off
+# Formato del número de IVA (sin el prefijo del país) de cada país
+VAT_FORMATS = {
+    "AT": r"U\d{8}",
+    "BE": r"[01]\d{9}",
+    "BG": r"\d{9,10}",
+    "CY": r"\d{8}[A-Z]",
+    "CZ": r"\d{8,10}",
+    "DE": r"\d{9}",
+    "DK": r"\d{8}",
+    "EE": r"\d{9}",
+    "EL": r"\d{9}",
+    "ES": r"[A-Z0-9]\d{7}[A-Z0-9]",
+    "FI": r"\d{8}",
+    "FR": r"[A-HJ-NP-Z0-9]{2}\d{9}",
+    "HR": r"\d{11}",
+    "HU": r"\d{8}",
+    "IE": r"\d{7}[A-W][A-IW]?|\d[A-Z+*]\d{5}[A-W]",
+    "IS": r"\d{5,6}",
+    "IT": r"\d{11}",
+    "LI": r"\d{5}",
+    "LT": r"\d{9}|\d{12}",
+    "LU": r"\d{8}",
+    "LV": r"\d{11}",
+    "MT": r"\d{8}",
+    "NL": r"\d{9}B\d{2}",
+    "NO": r"\d{9}(?:MVA)?",
+    "PL": r"\d{10}",
+    "PT": r"\d{9}",
+    "RO": r"[1-9]\d{1,9}",
+    "SE": r"\d{10}01",
+    "SI": r"\d{8}",
+    "SK": r"\d{10}",
+}
+# fmt: on
+
+# Grecia usa EL como prefijo del IVA en lugar de su código ISO
+VAT_PREFIXES = {"GR": "EL"}
+
+NIF_LETTERS = "TRWAGMYFPDXBNJZSQVHLCKE"
+CIF_LETTERS = "JABCDEFGHI"
+NIE_PREFIXES = {"X": "0", "Y": "1", "Z": "2"}
+
+# Caracteres que se quitan antes de validar: espacios, puntos, guiones y barras
+_CLEANUP = str.maketrans("", "", " .-/")
+
+# Los NIF de personas físicas con letra inicial (K, L, M) llevan la misma letra
+# de control que un DNI, calculada sobre los 7 dígitos
+_NIF = re.compile(r"(\d{8}|[KLM]\d{7})([A-Z])", re.ASCII)
+_NIE = re.compile(r"([XYZ])(\d{7})([A-Z])", re.ASCII)
+_CIF = re.compile(r"([ABCDEFGHJNPQRSUVW])(\d{7})([0-9A-J])", re.ASCII)
+
+
+def normalize(number: str) -> str:
+    return number.translate(_CLEANUP).upper()
+
+
+def valid_nif(number: str) -> bool:
+    match = _NIF.fullmatch(number)
+    if not match:
+        return False
+    digits = match[1].lstrip("KLM")
+    return NIF_LETTERS[int(digits) % 23] == match[2]
+
+
+def valid_nie(number: str) -> bool:
+    match = _NIE.fullmatch(number)
+    if not match:
+        return False
+    return NIF_LETTERS[int(NIE_PREFIXES[match[1]] + match[2]) % 23] == match[3]
+
+
+def valid_cif(number: str) -> bool:
+    match = _CIF.fullmatch(number)
+    if not match:
+        return False
+    kind, digits, control = match.groups()
+
+    total = 0
+    for i, digit in enumerate(digits):
+        if i % 2:
+            total += int(digit)
+        else:
+            doubled = int(digit) * 2
+            total += doubled // 10 + doubled % 10
+    check = (10 - total % 10) % 10
+
+    # Entidades sin ánimo de lucro, organismos públicos, extranjeras, etc.
+    # llevan letra de control; sociedades anónimas, limitadas, etc. llevan número
+    if kind in "NPQRSW":
+        return control == CIF_LETTERS[check]
+    if kind in "ABEH":
+        return control == str(check)
+    return control in (str(check), CIF_LETTERS[check])
+
+
+def _valid_spanish(number: str) -> bool:
+    if number.startswith("ES") and len(number) == 11:
+        number = number[2:]
+    if not number:
+        return False
+    if number[0].isdigit() or number[0] in "KLM":
+        return valid_nif(number)
+    if number[0] in NIE_PREFIXES:
+        return valid_nie(number)
+    return valid_cif(number)
+
+
+def valid_spanish_tax_id(number: str) -> bool:
+    """
+    Comprueba el dígito de control de un NIF, NIE o CIF, con o sin prefijo `ES`
+    """
+    return _valid_spanish(normalize(number))
+
+
+# Una regla recibe un número ya normalizado y dice si es válido
+Rule = Callable[[str], bool]
+
+
+def _compile_rule(country: str) -> Rule:
+    prefix = VAT_PREFIXES.get(country, country)
+    if prefix == "ES":
+        return _valid_spanish
+
+    pattern = re.compile(f"(?:{prefix})?(?:{VAT_FORMATS[prefix]})")
+    return lambda number: pattern.fullmatch(number) is not None
+
+
+# Reglas compiladas, por código de país (el de `customer["country"]`)
+RULES: dict[str, Rule] = {
+    country: _compile_rule(country) for country in [*VAT_FORMATS, *VAT_PREFIXES]
+}
+
+
+# Una regla de columna recibe los números ya normalizados, uno por línea (y con
+# un salto de línea más al principio y al final), y dice cuáles son válidos
+BulkRule = Callable[[str], np.ndarray]
+
+
+def _ascii_table(values: dict[str, int], default: int = -1) -> np.ndarray:
+    # Tabla indexada por código ASCII
+    table = np.full(128, default, dtype=np.int32)
+    for chars, value in values.items():
+        for char in chars:
+            table[ord(char)] = value
+    return table
+
+
+# Primera cifra del número sobre el que se calcula la letra de un NIF o NIE
+_NIF_FIRST = _ascii_table(
+    {**{str(digit): digit for digit in range(10)}, "KLM": 0, "X": 0, "Y": 1, "Z": 2}
+)
+# Control de un CIF según su letra: 1 letra, 2 número, 3 cualquiera de los dos
+_CIF_CONTROL = _ascii_table({"NPQRSW": 1, "ABEH": 2, "CDFGJUV": 3}, default=0)
+_NIF_CODES = np.array([ord(letter) for letter in NIF_LETTERS])
+_CIF_CODES = np.array([ord(letter) for letter in CIF_LETTERS])
+_POWERS = 10 ** np.arange(6, -1, -1, dtype=np.int32)
+
+
+def _valid_spanish_bulk(text: str) -> np.ndarray:
+    # Los mismos cálculos que `valid_nif`, `valid_nie` y `valid_cif`, pero
+    # sobre una matriz con los 9 caracteres de cada número. Lo que no es ASCII
+    # queda como "?", que nunca es válido
+    data = np.frombuffer(text.encode("ascii", "replace") + bytes(11), dtype=np.uint8)
+    breaks = np.flatnonzero(data == ord("\n"))
+    starts, lengths = breaks[:-1] + 1, np.diff(breaks) - 1
+    # El prefijo ES solo se quita si deja 9 caracteres, como en `_valid_spanish`
+    prefixed = (lengths == 11) & (data[starts] == ord("E"))
+    prefixed &= data[starts + 1] == ord("S")
+    starts, lengths = starts + 2 * prefixed, lengths - 2 * prefixed
+
+    codes = data[starts[:, np.newaxis] + np.arange(9)]
+    kind, control = codes[:, 0], codes[:, 8]
+    digits = codes[:, 1:8].astype(np.int32) - ord("0")
+    well_formed = (lengths == 9) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+
+    first = _NIF_FIRST[kind]
+    letter = _NIF_CODES[(first * 10**7 + digits @ _POWERS) % 23]
+    personal = (first >= 0) & (control == letter)
+
+    doubled = digits[:, ::2] * 2
+    total = (doubled - 9 * (doubled > 9)).sum(axis=1) + digits[:, 1::2].sum(axis=1)
+    check = (10 - total % 10) % 10
+    cif = _CIF_CONTROL[kind]
+    company = ((cif & 1) > 0) & (control == _CIF_CODES[check])
+    company |= ((cif & 2) > 0) & (control == check + ord("0"))
+
+    return well_formed & (personal | company)
+
+
+def _compile_bulk_rule(country: str) -> BulkRule:
+    prefix = VAT_PREFIXES.get(country, country)
+    if prefix == "ES":
+        return _valid_spanish_bulk
+
+    # Un único patrón por país: las líneas válidas se cambian por un punto, que
+    # nunca queda en un número normalizado. Buscamos los números entre saltos
+    # de línea porque es mucho más rápido que `^` y `$` con `re.MULTILINE`, que
+    # prueban a empezar en cada carácter
+    pattern = re.compile(f"\\n(?:{prefix})?(?:{VAT_FORMATS[prefix]})(?=\\n)")
+
+    def rule(text: str) -> np.ndarray:
+        lines = pattern.sub("\n.", text)[1:-1].split("\n")
+        return np.fromiter(map(".".__eq__, lines), dtype=bool, count=len(lines))
+
+    return rule
+
+
+BULK_RULES: dict[str, BulkRule] = {
+    country: _compile_bulk_rule(country) for country in RULES
+}
+
+
+def validate_tax_number(number: str, country: str) -> bool:
+    """
+    Comprueba si un número de IVA es válido para el país indicado
+
+    Los países sin reglas (los no europeos) no se validan y se dan por buenos.
+
+    :param number: El número de IVA, con o sin prefijo de país
+    :type number: str
+    :param country: El código de país ISO de la entidad
+    :type country: str
+    :return: Si el número es válido
+    :rtype: bool
+    """
+    rule = RULES.get(country)
+    return rule is None or rule(normalize(number or ""))
+
+
+def validate_column(numbers: Sequence[str], countries: Sequence[str]) -> list[int]:
+    """
+    Valida una columna entera de números de IVA y devuelve las filas inválidas
+
+    Da el mismo resultado que `validate_tax_number` fila a fila, pero aplica la
+    regla de cada país a todos sus números de una vez.
+
+    :param numbers: Los números de IVA
+    :type numbers: Sequence[str]
+    :param countries: El código de país de cada fila
+    :type countries: Sequence[str]
+    :return: Los índices de las filas con números inválidos, en orden
+    :rtype: list[int]
+    """
+    if len(numbers) != len(countries):
+        raise ValueError("Las columnas de números y de países no miden lo mismo")
+
+    # Ordenamos las filas por país para tener juntos los números de cada uno
+    codes = {country: code for code, country in enumerate(set(countries))}
+    by_country = np.fromiter(
+        map(codes.__getitem__, countries), dtype=np.intp, count=len(countries)
+    )
+    order = np.argsort(by_country, kind="stable")
+    ends = np.cumsum(np.bincount(by_country, minlength=len(codes))).tolist()
+    ordered = np.array(numbers, dtype=object)[order]
+
+    valid = np.ones(len(numbers), dtype=bool)
+    start = 0
+    for country, end in zip(codes, ends):
+        indices, column = order[start:end], ordered[start:end].tolist()
+        start = end
+        rule = BULK_RULES.get(country)
+        if rule is None:
+            continue
+        if None in column:
+            column = [number or "" for number in column]
+        text = "\n".join(column)
+        multiline = {}
+        if text.count("\n") != len(column) - 1:
+            # Los números con saltos de línea se validan aparte, uno a uno
+            multiline = {j: n for j, n in enumerate(column) if "\n" in n}
+            for j in multiline:
+                column[j] = ""
+            text = "\n".join(column)
+        valid[indices] = rule(f"\n{normalize(text)}\n")
+        for j, number in multiline.items():
+            valid[indices[j]] = validate_tax_number(number, country)
+    return np.flatnonzero(~valid).tolist()
+
+
+def invalid_records(
+    records: Iterable[dict],
+    number_field: str = "taxRegistrationNumber",
+    country_field: str = "country",
+) -> list[dict]:
+    """
+    Devuelve los registros (p.ej. clientes de BC) con números de IVA inválidos
+
+    :param records: Los registros a validar
+    :type records: Iterable[dict]
+    :param number_field: El campo con el número de IVA,
+        defaults to "taxRegistrationNumber"
+    :type number_field: str, optional
+    :param country_field: El campo con el país, defaults to "country"
+    :type country_field: str, optional
+    :return: Los registros inválidos
+    :rtype: list[dict]
+    """
+    records = list(records)
+    rows = validate_column(
+        [record[number_field] for record in records],
+        [record[country_field] for record in records],
+    )
+    return [records[i] for i in rows]